@@ -1,20 +1,37 @@
-from gensim.models.doc2vec import Doc2Vec
-from gensim.utils import simple_preprocess
 from functools import total_ordering
-from itertools import combinations
+import heapq
+from numpy import triu_indices, unique, maximum
 from cached_property import cached_property
 from treelib import Node, Tree
 
+#Retention modes for the outside nodes of an analysis unit. Robustness only needs their number, so on
+#dense classification systems keeping every (node, node, similarity) tuple is wasteful.
+OUTSIDE_FULL = "full"
+OUTSIDE_COUNT = "count"
+OUTSIDE_TOPK = "topk"
+OUTSIDE_MODES = (OUTSIDE_FULL, OUTSIDE_COUNT, OUTSIDE_TOPK)
+
+OLD_FORMAT = 'Analysis units file was created by an older version, the analysis units have to be created again.'
+
 @total_ordering
 class AnalysisUnit:
+    '''The nodes of an analysis unit are rows in the node table of the vector resolution shared by all analysis
+    units of a tree (see NodeVectors and VocabularyResolution). The similarities of the pairs are kept in an
+    array in the order of combinations of the usable nodes; Pair objects are only created when they are needed.'''
     @total_ordering
     class Pair:
-        def __init__(self, node0, node1, similarity, unknown_tokens = []):
+        __slots__ = ('node0', 'node1', '_similarity', 'unknown_tokens')
+
+        def __init__(self, node0, node1, similarity, unknown_tokens = ()):
             self.node0 = node0
             self.node1 = node1
             self._similarity = similarity
             self.unknown_tokens = unknown_tokens
 
+        def __setstate__(self, state):
+            #Pairs are only pickled by older versions, which kept them as objects in the analysis units.
+            raise ValueError(OLD_FORMAT)
+
         def __eq__(self, other):
             return self.similarity() == other.similarity()
 
@@ -40,46 +57,31 @@ class AnalysisUnit:
 
             return f'{ut}Similarity: {self.similarity()}'
 
-    def __init__(self, identifier, nodes, model):
-        self.nodes = nodes
-        self.unusable_nodes = set()
-        self.doc2vec = model
-        self.pairs = list()
+    def __init__(self, identifier, nodes, vectors, outside_mode = OUTSIDE_FULL, outside_k = 10):
+        assert outside_mode in OUTSIDE_MODES, f'Unknown outside node retention mode: {outside_mode}'
+        assert outside_mode != OUTSIDE_TOPK or outside_k > 0, f'Top-k retention needs a positive k: {outside_k}'
         self.identifier = identifier
+        self.vectors = vectors
+        self.outside_mode = outside_mode
+        self.outside_k = outside_k
         self.outside_nodes = list()
+        self.outside_count = 0
         self.min_similarity = -1
         self.max_similarity = -1
 
-        for pair in combinations(range(0, len(self.nodes)), 2):
-            leaf0 = self.nodes[pair[0]]
-            leaf1 = self.nodes[pair[1]]
-            tokens0 = simple_preprocess(leaf0.tag, max_len=100)
-            tokens1 = simple_preprocess(leaf1.tag, max_len=100)
-
-            if len(tokens0) == 0:
-                self.unusable_nodes.add(leaf0)
-                continue
-
-            if len(tokens1) == 0:
-                self.unusable_nodes.add(leaf1)
-                continue
+        #Nodes without tokens or with unknown tokens (see VocabularyResolution) are not usable.
+        self.node_rows = vectors.rows(nodes)
+        usable = vectors.resolution.usable[self.node_rows]
+        self.usable_rows = self.node_rows[usable]
+        self.unusable_rows = self.node_rows[~usable]
 
-            unknown_tokens0 = self.__find_unknown_tokens(tokens0)
-            unknown_tokens1 = self.__find_unknown_tokens(tokens1)
-
-            if len(unknown_tokens0) != 0:
-                leaf0.data = unknown_tokens0
-                self.unusable_nodes.add(leaf0)
-                continue
-
-            if len(unknown_tokens1) != 0:
-                leaf1.data = unknown_tokens1
-                self.unusable_nodes.add(leaf1)
-                continue
-
-            similarity = self.doc2vec.wv.n_similarity(tokens0, tokens1)
-            self.pairs.append(self.Pair(leaf0, leaf1, similarity))
+        #Set by calculate_similarities
+        self.pair_similarities = None
 
+    def __setstate__(self, state):
+        if 'node_rows' not in state:
+            raise ValueError(OLD_FORMAT)
+        self.__dict__.update(state)
 
     def __eq__(self, other):
         return (self.minimum_similarity, self.min_max_similarity()) == (other.minimum_similarity, other.min_max_similarity())
@@ -87,20 +89,73 @@ class AnalysisUnit:
     def __lt__(self, other):
         return (self.minimum_similarity, self.min_max_similarity()) < (other.minimum_similarity, other.min_max_similarity())
 
-    def outside_similarity(self, other):
-        """This is the key measure for defining robustness. Here we measure for each node the similarity to each node from the other analysis unit. If the similarity to an other node is higher than the minimum similarity within the analysis unit, we add that outside node to a list in this analysis unit. Note that we can calculate the outside similarity if we have a minimum similarity, i.e. we have more than one pair in this analysis unit."""
-        if len(self.pairs) > 1:
-            for self_node in self.nodes:
-                for other_node in other.nodes:
-                    self_tokens = simple_preprocess(self_node.tag, max_len=100)
-                    other_tokens = simple_preprocess(other_node.tag, max_len=100)
-
-                    unknown_tokens = self.__find_unknown_tokens(self_tokens + other_tokens)
-
-                    if len(unknown_tokens) == 0 and len(self_tokens) > 0 and len(other_tokens) > 0:
-                        similarity = self.doc2vec.wv.n_similarity(self_tokens, other_tokens)
-                        if similarity > self.minimum_similarity:
-                            self.outside_nodes.append((self_node, other_node, similarity))
+    def __pair_indices(self):
+        #Same order as combinations(range(0, len(self.usable_rows)), 2)
+        return triu_indices(len(self.usable_rows), 1)
+
+    def __node(self, row):
+        return self.vectors.resolution.nodes[row]
+
+    @property
+    def unusable_nodes(self):
+        return [self.__node(row) for row in self.unusable_rows]
+
+    @property
+    def pairs(self):
+        rows0, rows1 = self.__pair_indices()
+        return [self.Pair(self.__node(self.usable_rows[i]), self.__node(self.usable_rows[j]), similarity)
+                for i, j, similarity in zip(rows0, rows1, self.pair_similarities)]
+
+    def calculate_similarities(self, outside_rows, outside_units):
+        """Calculates the similarities of the pairs in this analysis unit and the outside similarity, the key measure for defining robustness. Here we measure for each node the similarity to each node from the other analysis units (outside_rows, with the analysis unit each of them belongs to in outside_units). If the similarity to an other node is higher than the minimum similarity within the analysis unit, we count that outside node and, depending on the retention mode, keep it in this analysis unit. Note that we can calculate the outside similarity if we have a minimum similarity, i.e. we have more than one pair in this analysis unit.
+
+        All similarities are taken from one product of the distinct vectors of this analysis unit with the vector table, so that nodes with the same vector get exactly the same similarities. Like n_similarity, the similarity of a pair does not depend on the order of its nodes."""
+        ids = self.vectors.ids[self.usable_rows]
+        distinct_ids, rows = unique(ids, return_inverse=True)
+        rows = rows.reshape(-1)
+        similarities = self.vectors.similarities(distinct_ids)
+
+        first, second = self.__pair_indices()
+        self.pair_similarities = maximum(similarities[rows[first], ids[second]], similarities[rows[second], ids[first]])
+
+        if len(self.pair_similarities) > 1:
+            outside = similarities[:, self.vectors.ids[outside_rows]] > self.minimum_similarity
+
+            if self.outside_mode == OUTSIDE_COUNT:
+                self.outside_count += int(outside.sum(axis=1)[rows].sum())
+                return
+
+            #Outside nodes in the order of the analysis units, then of the nodes of this analysis unit
+            self_rows, columns = outside[rows].nonzero()
+            order = outside_units[columns].argsort(kind='stable')
+            self_rows, columns = self_rows[order], columns[order]
+            values = similarities[rows[self_rows], self.vectors.ids[outside_rows[columns]]]
+            count = self.outside_count
+            self.outside_count += len(self_rows)
+
+            if self.outside_mode == OUTSIDE_FULL and len(self_rows) > 0:
+                self.outside_nodes.append((self.usable_rows[self_rows], outside_rows[columns], values))
+            elif self.outside_mode == OUTSIDE_TOPK:
+                self.__keep_top_outside_nodes(self.usable_rows[self_rows], outside_rows[columns], values, count)
+
+    def __keep_top_outside_nodes(self, rows, other_rows, similarities, count):
+        #Min-heap of the k most similar outside nodes. The running count breaks ties between equal similarities.
+        #Once the heap is full, only outside nodes more similar than its least similar one can get in.
+        threshold = self.outside_nodes[0][0] if len(self.outside_nodes) == self.outside_k else -2
+        for i in (similarities > threshold).nonzero()[0]:
+            entry = (similarities[i], count + i + 1, rows[i], other_rows[i])
+            if len(self.outside_nodes) < self.outside_k:
+                heapq.heappush(self.outside_nodes, entry)
+            elif similarities[i] > self.outside_nodes[0][0]:
+                heapq.heapreplace(self.outside_nodes, entry)
+
+    def similar_outside_nodes(self):
+        """Returns the retained outside nodes as (node, outside node, similarity) tuples. In top-k mode they are sorted by decreasing similarity, in count mode nothing is retained."""
+        if self.outside_mode == OUTSIDE_TOPK:
+            return [(self.__node(entry[2]), self.__node(entry[3]), entry[0]) for entry in sorted(self.outside_nodes, reverse = True)]
+        return [(self.__node(row), self.__node(other_row), similarity)
+                for rows, other_rows, similarities in self.outside_nodes
+                for row, other_row, similarity in zip(rows, other_rows, similarities)]
 
     @cached_property
     def minimum_similarity(self):
@@ -121,27 +176,21 @@ class AnalysisUnit:
     def __edge_values_similarity(self, rev):
         value = -1
 
-        if len(self.pairs) > 1:
-            sorted_pairs = sorted(self.pairs, reverse = rev)
-            value = sorted_pairs[0].similarity()
+        if len(self.pair_similarities) > 1:
+            value = self.pair_similarities.max() if rev else self.pair_similarities.min()
 
         return value
 
     def describe(self):
-        description = f'Identifier: {self.identifier}\nNumber of nodes: {len(self.nodes)}\nMin|Max similarity: {self.minimum_similarity}|{self.maximum_similarity}\nMin-Max similarity: {self.min_max_similarity()}\nNumber of pairs: {len(self.pairs)}\n'
+        description = f'Identifier: {self.identifier}\nNumber of nodes: {len(self.node_rows)}\nMin|Max similarity: {self.minimum_similarity}|{self.maximum_similarity}\nMin-Max similarity: {self.min_max_similarity()}\nNumber of pairs: {len(self.pair_similarities)}\n'
         for node in self.unusable_nodes:
-            description = description + f'\tIdentifier: {node.identifier} | Content: {node.tag} | Unknown tokens: {node.data}\n'
-        description = description + f'Number of pairs: {len(self.pairs)}\n'
+            description = description + f'\tIdentifier: {node.identifier} | Content: {node.tag} | Unknown tokens: {self.vectors.resolution.unknown_tokens(node.identifier) or None}\n'
+        description = description + f'Number of pairs: {len(self.pair_similarities)}\n'
         for pair in sorted(self.pairs, reverse = True):
             description = description + f'\t{pair.describe()}\n'
-        description = description + f'Number of similar outside nodes: {len(self.outside_nodes)}\n'
-        for outside_node in self.outside_nodes:
+        description = description + f'Number of similar outside nodes: {self.outside_count}\n'
+        if self.outside_mode == OUTSIDE_TOPK:
+            description = description + f'Most similar outside nodes (top {self.outside_k}):\n'
+        for outside_node in self.similar_outside_nodes():
             description = description + f'\tI: {outside_node[0]} | O: {outside_node[1]} | S: {outside_node[2]}\n'
         return description
-
-    def __find_unknown_tokens(self, tokens):
-        result = list()
-        for token in tokens:
-            if not token in self.doc2vec.wv.vocab:
-                result.append(token)
-        return result
@@ -1,31 +1,92 @@
+import argparse
+import multiprocessing
+import os
 import os.path
-from au import AnalysisUnit
+from concurrent.futures import ProcessPoolExecutor
+from au import OUTSIDE_MODES, OUTSIDE_FULL, OUTSIDE_TOPK
+from vectors import PRECISIONS, FLOAT32
+from vocab import VocabularyResolution
 import treeify
 import utils
 import metrics
-from gensim.models.doc2vec import Doc2Vec
+
+#gensim is only imported when a stage needs a doc2vec model, so that e.g. conciseness of a single
+#classification system does not wait for the models to be loaded.
 
 results_path = "results"
 
-print('Loading doc2vec models...')
-model_en = Doc2Vec.load("models/wikipedia_en_20210308")
-model_sv = Doc2Vec.load("models/wikipedia_sv_20210412")
+model_paths = {
+    "en": "models/wikipedia_en_20210308",
+    "sv": "models/wikipedia_sv_20210412"
+}
 
+#The language selects the doc2vec model. Classification systems without a model (None) only get conciseness.
 csystems = [
-    { "name": "uniclass", "creator": treeify.uniclass, "d2vmodel": model_en},
-    { "name": "omniclass","creator": treeify.omniclass, "d2vmodel": model_en},
-    { "name": "coclass", "creator": treeify.coclass, "d2vmodel": model_sv},
-    { "name": "sb11", "creator": treeify.sb11, "d2vmodel": model_sv},
-    { "name": "naics", "creator": treeify.naics, "d2vmodel": model_en},
-    { "name": "nace", "creator": treeify.nace, "d2vmodel": model_en},
-    { "name": "eucyber", "creator": treeify.eucyber, "d2vmodel": model_en},
-    { "name": "mahaini", "creator": treeify.mahaini, "d2vmodel": model_en}
+    { "name": "uniclass", "creator": treeify.uniclass, "language": "en"},
+    { "name": "omniclass","creator": treeify.omniclass, "language": "en"},
+    { "name": "coclass", "creator": treeify.coclass, "language": "sv"},
+    { "name": "sb11", "creator": treeify.sb11, "language": "sv"},
+    { "name": "naics", "creator": treeify.naics, "language": "en"},
+    { "name": "nace", "creator": treeify.nace, "language": "en"},
+    { "name": "eucyber", "creator": treeify.eucyber, "language": "en"},
+    { "name": "mahaini", "creator": treeify.mahaini, "language": "en"}
 ]
 
+STAGES = ("conciseness", "oov", "units", "robustness", "validate")
+#oov and validate are opt-in: validate creates the analysis units once more in float32 and once per validated precision.
+DEFAULT_STAGES = ("conciseness", "units", "robustness")
+FORMATS = ("txt", "json")
+
+models = dict()
+
+def load_model(language):
+    if language not in models:
+        from gensim.models.doc2vec import Doc2Vec
+        print(f'Loading {language} doc2vec model...')
+        models[language] = Doc2Vec.load(model_paths[language])
+    return models[language]
+
+def needs_model(csystem, args):
+    '''Stages oov, units and validate always need the model, robustness only if there is no analysis units file yet.
+    Whether an existing file can be reused is only known once it is loaded; if not, evaluate loads the model itself.'''
+    if csystem["language"] is None:
+        return False
+    if "oov" in args.stages or "units" in args.stages or "validate" in args.stages:
+        return True
+    return "robustness" in args.stages and not os.path.isfile(f'{units_prefix(csystem, args)}.au')
+
+def units_prefix(csystem, args):
+    '''Analysis units and robustness calculated with reduced precision vectors are stored separately.'''
+    if args.precision == FLOAT32:
+        return f'{args.results}/{csystem["name"]}'
+    return f'{args.results}/{csystem["name"]}.{args.precision}'
 
-for csystem in csystems:
-    csfile = f'{results_path}/{csystem["name"]}.tree'
+def load_analysis_units(aufile, args):
+    '''Returns the analysis units stored in aufile, or None if they were created by an older version, or with other
+    outside node settings when stage units is run. Robustness only needs the number of outside nodes, which is the
+    same in all outside modes, so it uses the analysis units whatever their settings.'''
+    try:
+        aunits = utils.load_object(aufile)
+    except ValueError as error:
+        print(f'{error} ({aufile})')
+        return None
+    if "units" not in args.stages:
+        return aunits
+    for unit in aunits:
+        if unit.outside_mode != args.outside_mode or (args.outside_mode == OUTSIDE_TOPK and unit.outside_k != args.outside_k):
+            print(f'Analysis units in {aufile} keep outside nodes in mode {unit.outside_mode} (k={unit.outside_k}), creating them again...')
+            return None
+    return aunits
+
+def save_result(txt, values, filename, formats):
+    if "txt" in formats:
+        utils.save_text(txt, filename)
+    if "json" in formats:
+        utils.save_json(values, f'{filename}.json')
+
+def evaluate(csystem, args):
     csname = csystem["name"]
+    csfile = f'{args.results}/{csname}.tree'
     if os.path.isfile(csfile):
         print(f'Using existing {csname} tree stored in: {csfile}')
         cstree = utils.load_object(csfile)
@@ -33,24 +94,94 @@ for csystem in csystems:
         print(f'Creating new {csname} tree...')
         cstree = csystem["creator"](csname)
         utils.save_object(cstree, csfile)
-    csystem["tree"] = cstree
 
-    print(f'Calculating conciseness for {csname}...')
-    csystem["conciseness"] = metrics.conciseness(cstree, 0)
-    utils.save_text(csystem["conciseness"], f'{results_path}/{csystem["name"]}.cc')
+    if "conciseness" in args.stages:
+        print(f'Calculating conciseness for {csname}...')
+        save_result(metrics.conciseness(cstree, 0), metrics.conciseness_values(cstree), f'{args.results}/{csname}.cc', args.formats)
 
-    aufile = f'{results_path}/{csystem["name"]}.au'
-    if os.path.isfile(aufile):
-        print(f'Using existing {csname} analysis units file: {aufile}')
-        aunits = utils.load_object(aufile)
-    else:
-        if csystem["d2vmodel"] is not None:
+    if csystem["language"] is None:
+        return
+
+    resolution = None
+    if "oov" in args.stages:
+        print(f'Resolving {csname} vocabulary...')
+        resolution = VocabularyResolution(cstree, load_model(csystem["language"]).wv)
+        utils.save_text(resolution.describe(), f'{args.results}/{csname}.oov')
+
+    if "units" in args.stages or "robustness" in args.stages:
+        aufile = f'{units_prefix(csystem, args)}.au'
+        aunits = None
+        if os.path.isfile(aufile):
+            print(f'Using existing {csname} analysis units file: {aufile}')
+            aunits = load_analysis_units(aufile, args)
+        if aunits is None:
             print(f'Creating new {csname} analysis units...')
-            aunits = metrics.create_analysis_units(cstree, csystem["d2vmodel"])
-            utils.save_object(aunits, f'{results_path}/{csystem["name"]}.au')
-            utils.save_analysis_units_description(aunits, f'{results_path}/{csystem["name"]}.au.txt')
+            aunits = metrics.create_analysis_units(cstree, load_model(csystem["language"]), args.outside_mode, args.outside_k, resolution, args.precision)
+            utils.save_object(aunits, aufile)
+            utils.save_analysis_units_description(aunits, f'{aufile}.txt')
 
-    if csystem["d2vmodel"] is not None:
+    if "robustness" in args.stages:
         print(f'Calculating robustness for {csname}...')
-        csystem["robustness"] = metrics.robustness(aunits)
-        utils.save_text(csystem["robustness"], f'{results_path}/{csystem["name"]}.rb')
+        save_result(metrics.robustness(aunits), metrics.robustness_values(aunits), f'{units_prefix(csystem, args)}.rb', args.formats)
+
+    if "validate" in args.stages:
+        #Without a reduced precision selected, both reduced precisions are validated.
+        precisions = [args.precision] if args.precision != FLOAT32 else [precision for precision in PRECISIONS if precision != FLOAT32]
+        print(f'Validating {" and ".join(precisions)} vectors for {csname}...')
+        validations = metrics.precision_validation(cstree, load_model(csystem["language"]), precisions, resolution)
+        for precision in precisions:
+            utils.save_text(validations[precision], f'{args.results}/{csname}.{precision}.val')
+
+def parse_arguments(argv = None):
+    names = [csystem["name"] for csystem in csystems]
+    parser = argparse.ArgumentParser(description='Evaluate conciseness and robustness of classification systems.')
+    parser.add_argument('systems', nargs='*', default=[],
+                        help=f'Classification systems to evaluate (default: all). One or more of: {", ".join(names)}')
+    parser.add_argument('-s', '--stages', nargs='+', choices=STAGES, default=list(DEFAULT_STAGES),
+                        help=f'Stages to run (default: {" ".join(DEFAULT_STAGES)}). Robustness uses an existing analysis units file if there is one.')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Number of classification systems evaluated in parallel processes (default: 1)')
+    parser.add_argument('-f', '--formats', nargs='+', choices=FORMATS, default=["txt"],
+                        help='Output formats of the conciseness and robustness results (default: txt)')
+    parser.add_argument('-r', '--results', default=results_path,
+                        help=f'Directory for trees, analysis units and results (default: {results_path})')
+    parser.add_argument('--outside-mode', choices=OUTSIDE_MODES, default=OUTSIDE_FULL,
+                        help='Outside nodes kept in the analysis units: all, only their count, or the top k (default: full)')
+    parser.add_argument('--outside-k', type=int, default=10,
+                        help='Number of outside nodes kept per analysis unit in topk mode (default: 10)')
+    parser.add_argument('-p', '--precision', choices=PRECISIONS, default=FLOAT32,
+                        help='Precision in which the node vectors are stored. Similarities are always calculated in float32, so float16 and int8 '
+                             'give no speedup; they only measure the accuracy loss of storing the vectors with less precision, '
+                             'which stage validate reports against float32 (default: float32)')
+    args = parser.parse_args(argv)
+
+    unknown = [name for name in args.systems if name not in names]
+    if len(unknown) > 0:
+        parser.error(f'unknown classification systems: {", ".join(unknown)}')
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+    if args.outside_k < 1:
+        parser.error('--outside-k must be at least 1')
+    return args
+
+def main(argv = None):
+    args = parse_arguments(argv)
+    selected = [csystem for csystem in csystems if len(args.systems) == 0 or csystem["name"] in args.systems]
+    os.makedirs(args.results, exist_ok=True)
+
+    if args.workers == 1:
+        for csystem in selected:
+            evaluate(csystem, args)
+    else:
+        #Models are loaded before the worker processes are started so that forked workers share them
+        #instead of loading their own copy. Workers are always forked, since with spawn or forkserver
+        #(the default on macOS and from Python 3.14 on Linux) they would load the models once more.
+        for csystem in selected:
+            if needs_model(csystem, args):
+                load_model(csystem["language"])
+        with ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context("fork")) as executor:
+            for result in [executor.submit(evaluate, csystem, args) for csystem in selected]:
+                result.result()
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,16 @@
 from treelib import Node, Tree
 from math import log
-from itertools import permutations
-from au import AnalysisUnit
+import numpy as np
+from time import perf_counter
+from au import AnalysisUnit, OUTSIDE_FULL, OUTSIDE_COUNT
+from vectors import NodeVectors, FLOAT32
+from vocab import VocabularyResolution
 
-def conciseness(tree, level, cs_name = None, result = None):
+def simplicity(tree):
     '''We use the metric definition of simplicity from the supplement material from the paper
-    "A Taxonomy of Evaluation Methods for Information Systems Artifacts" (Prat et al. 2015)'''
+    "A Taxonomy of Evaluation Methods for Information Systems Artifacts" (Prat et al. 2015)
+
+    Returns the name of the tree root, the number of categories and characteristics, and the conciseness.'''
 
     depth_categories = 0
     depth_characteristics = 0
@@ -28,6 +33,11 @@ def conciseness(tree, level, cs_name = None, result = None):
 
     cc = 1/(1 + log((depth_categories + depth_characteristics) - 1))
 
+    return name, number_categories, number_characteristics, cc
+
+def conciseness(tree, level, cs_name = None, result = None):
+    name, number_categories, number_characteristics, cc = simplicity(tree)
+
     if level == 0:
         result = 'Classification system: '
     elif level == 1:
@@ -42,7 +52,17 @@ def conciseness(tree, level, cs_name = None, result = None):
 
     return result
 
-def robustness(units):
+def conciseness_values(tree):
+    '''Same as conciseness, but as a dictionary for machine-readable output.'''
+    def values(subtree):
+        name, number_categories, number_characteristics, cc = simplicity(subtree)
+        return {"name": name, "categories": number_categories, "characteristics": number_characteristics, "conciseness": cc}
+
+    result = values(tree)
+    result["tables"] = [values(tree.subtree(table.identifier)) for table in tree.children("root")]
+    return result
+
+def robustness_values(units):
     '''We determine robustness through:
     (a) the similarity of the nodes in a unit to each other
     (b) the dissimilarity of nodes in a unit to nodes outside the unit
@@ -59,35 +79,47 @@ def robustness(units):
 
     The overall robustness of a set of analysis units is their arithmetic mean.
     '''
+    total_nodes = 0
     total_usable_nodes = 0
     total_unusable_nodes = 0
     for unit in units:
-        total_usable_nodes = total_usable_nodes + len(unit.nodes)
-        total_unusable_nodes = total_unusable_nodes + len(unit.unusable_nodes)
-    total_nodes = total_usable_nodes + total_unusable_nodes
-
+        total_nodes = total_nodes + len(unit.node_rows)
+        total_usable_nodes = total_usable_nodes + len(unit.usable_rows)
+        total_unusable_nodes = total_unusable_nodes + len(unit.unusable_rows)
 
     rb = 0
     units_rb = []
 
     for unit in units:
-        usable_nodes = len(unit.nodes)
-        unusable_nodes = len(unit.unusable_nodes)
-        nodes_in_au = usable_nodes + unusable_nodes
-        outside_nodes = len(unit.outside_nodes)
-        outside_proportion = outside_nodes / (usable_nodes * (total_usable_nodes - usable_nodes))
+        nodes = len(unit.node_rows)
+        outside_nodes = unit.outside_count
+        outside_proportion = outside_nodes / (nodes * (total_nodes - nodes))
         assert outside_proportion >= 0 and outside_proportion <= 1, f'Outside proportion is beyond expected interval: {outside_proportion}'
         rb = rb + 1 - outside_proportion
-        units_rb.append((unit.identifier, nodes_in_au, usable_nodes, unusable_nodes, outside_nodes, outside_proportion))
+        units_rb.append({"unit": unit.identifier, "total_nodes": nodes, "usable_nodes": len(unit.usable_rows), "unusable_nodes": len(unit.unusable_rows), "outside_nodes": outside_nodes, "outside_proportion": outside_proportion})
+
+    return {"robustness": rb / len(units), "units": len(units), "total_nodes": total_nodes, "usable_nodes": total_usable_nodes, "unusable_nodes": total_unusable_nodes,
+            "unit_robustness": sorted(units_rb, key=lambda unit_rb: unit_rb["outside_proportion"])}
+
+def robustness(units):
+    '''Text report of robustness_values.'''
+    values = robustness_values(units)
 
-    result = f'Robustness: {rb / len(units)} | Units: {len(units)} | Total/Usable/Unusable nodes: {total_nodes}/{total_usable_nodes}/{total_unusable_nodes}\n'
-    for unit_rb in sorted(units_rb, key=lambda tup: tup[5]):
-        result = result + f'\tUnit: {unit_rb[0]} | Total/Usable/Unusable nodes: {unit_rb[1]}/{unit_rb[2]}/{unit_rb[3]} | Outside nodes: {unit_rb[4]} | Outside proportion: {unit_rb[5]}\n'
+    #The text report keeps its original figures: "Usable" are all nodes of the analysis units and "Total" adds
+    #the unusable nodes to them once more.
+    result = f'Robustness: {values["robustness"]} | Units: {values["units"]} | Total/Usable/Unusable nodes: {values["total_nodes"] + values["unusable_nodes"]}/{values["total_nodes"]}/{values["unusable_nodes"]}\n'
+    for unit_rb in values["unit_robustness"]:
+        result = result + f'\tUnit: {unit_rb["unit"]} | Total/Usable/Unusable nodes: {unit_rb["total_nodes"] + unit_rb["unusable_nodes"]}/{unit_rb["total_nodes"]}/{unit_rb["unusable_nodes"]} | Outside nodes: {unit_rb["outside_nodes"]} | Outside proportion: {unit_rb["outside_proportion"]}\n'
 
     return result
 
 
-def create_analysis_units(tree, model):
+def create_analysis_units(tree, model, outside_mode = OUTSIDE_FULL, outside_k = 10, resolution = None, precision = FLOAT32):
+    #The tokens of all nodes are resolved against the vocabulary of the model once for the whole tree.
+    if resolution is None:
+        resolution = VocabularyResolution(tree, model.wv)
+    vectors = NodeVectors(resolution, model.wv, precision)
+
     #We store the leaf nodes in a dictionary. Key is their parent node. Since it's a dictionary
     #multiple insertions of the same parent node with children has a performance impact, but we don't have to
     #take care of the filtering logic.
@@ -111,11 +143,45 @@ def create_analysis_units(tree, model):
         #Hence, analysis units with less than 3 nodes are not interesting.
         if len(nodes) > 2:
             id = tree.parent(nodes[0].identifier).identifier
-            analysis_units.append(AnalysisUnit(id, nodes, model))
+            analysis_units.append(AnalysisUnit(id, nodes, vectors, outside_mode, outside_k))
 
-    for p in permutations(range(0, len(analysis_units)), 2):
-        p_zero = analysis_units[p[0]]
-        p_one = analysis_units[p[1]]
-        p_zero.outside_similarity(p_one)
+    #The usable nodes of all analysis units, and the analysis unit each of them belongs to
+    usable_rows = np.concatenate([unit.usable_rows for unit in analysis_units] + [np.empty(0, dtype=np.int32)])
+    usable_units = np.repeat(np.arange(len(analysis_units)), [len(unit.usable_rows) for unit in analysis_units])
+
+    for position, unit in enumerate(analysis_units):
+        outside = usable_units != position
+        unit.calculate_similarities(usable_rows[outside], usable_units[outside])
 
     return analysis_units
+
+def precision_validation(tree, model, precisions, resolution = None):
+    '''Creates the analysis units once with float32 and once with each of the given precisions of the node vectors.
+    Returns a report per precision with the robustness and time of both, and the analysis units whose number of
+    outside nodes differs.'''
+    if resolution is None:
+        resolution = VocabularyResolution(tree, model.wv)
+
+    runs = dict()
+    for run_precision in [FLOAT32] + [precision for precision in precisions if precision != FLOAT32]:
+        start = perf_counter()
+        units = create_analysis_units(tree, model, OUTSIDE_COUNT, resolution = resolution, precision = run_precision)
+        runs[run_precision] = (perf_counter() - start, {unit.identifier: unit for unit in units}, robustness_values(units))
+
+    time0, units0, rb0 = runs[FLOAT32]
+    outside0 = sum(unit.outside_count for unit in units0.values())
+    results = dict()
+    for precision in precisions:
+        time1, units1, rb1 = runs[precision]
+        different_units = [identifier for identifier in units0 if units0[identifier].outside_count != units1[identifier].outside_count]
+        outside1 = sum(unit.outside_count for unit in units1.values())
+
+        result = f'Accuracy loss of storing the node vectors in {precision}. Similarities are calculated in float32 in both runs, {precision} gives no speedup.\n'
+        result = result + f'Precision: {precision} | Robustness {FLOAT32}/{precision}: {rb0["robustness"]}/{rb1["robustness"]} | Difference: {rb1["robustness"] - rb0["robustness"]} | Units with different outside nodes: {len(different_units)}/{len(units0)} | Outside nodes {FLOAT32}/{precision}: {outside0}/{outside1} | Time {FLOAT32}/{precision}: {time0:.3f}s/{time1:.3f}s\n'
+        for identifier in different_units:
+            unit0 = units0[identifier]
+            unit1 = units1[identifier]
+            result = result + f'\tUnit: {identifier} | Minimum similarity: {unit0.minimum_similarity}/{unit1.minimum_similarity} | Outside nodes: {unit0.outside_count}/{unit1.outside_count}\n'
+        results[precision] = result
+
+    return results
@@ -1,18 +1,21 @@
 import glob
-import xlrd
 import re
 import csv
 import json
-from openpyxl import load_workbook
 import unicodedata as ud
 from treelib import Node, Tree
 
 ROOT_NAME = "root"
 BASE_PATH = "classification_systems"
 
+#xlrd and openpyxl are imported in the functions that read spreadsheets, so that the systems stored as csv
+#or json can be processed without loading them.
+
 def uniclass(name):
     path = f'{BASE_PATH}/uniclass'
 
+    from openpyxl import load_workbook
+
     tree = Tree()
     tree.create_node(name, ROOT_NAME)
     files = glob.glob(f'{path}/Uniclass2015*.xlsx')
@@ -78,6 +81,8 @@ def omniclass(name):
 
     path = f'{BASE_PATH}/omniclass'
 
+    import xlrd
+
     tree = Tree()
     tree.create_node(name, ROOT_NAME)
     files = glob.glob(f'{path}/OmniClass*.xls')
@@ -153,6 +158,7 @@ def sb11(name):
     tree = Tree()
     tree.create_node(name, ROOT_NAME)
 
+    from openpyxl import load_workbook
     wb = load_workbook(f'{path}/SB11 CAD-Lager_ Elementkod_2020-11-27 13_46_19.xlsx')
     for ws_name in wb.sheetnames:
         if ws_name == "Original":
@@ -204,6 +210,7 @@ def naics(name):
     #Since there are no tables in this classification, we create an artificial one so the analysis works.
     DUMMY_TABLE = "dummy_table"
     tree.create_node(DUMMY_TABLE, DUMMY_TABLE, ROOT_NAME)
+    from openpyxl import load_workbook
     wb = load_workbook(f'{BASE_PATH}/NAICS/2-6 digit_2017_Codes.xlsx')
     ws = wb.active
     data = ws.values
@@ -1,4 +1,5 @@
 import pickle
+import json
 
 def save_object(obj, filename):
     with open(filename, 'wb') as output:  # Overwrites any existing file.
@@ -12,6 +13,10 @@ def save_text(txt, filename):
     with open(filename, 'w') as output:
         output.write(txt)
 
+def save_json(obj, filename):
+    with open(filename, 'w') as output:
+        json.dump(obj, output, indent=2)
+
 def save_analysis_units_description(units, filename):
     ret = ""
     for unit in sorted(units, reverse = True):
@@ -0,0 +1,73 @@
+import numpy as np
+
+FLOAT32 = "float32"
+FLOAT16 = "float16"
+INT8 = "int8"
+PRECISIONS = (FLOAT32, FLOAT16, INT8)
+
+#Rows of the vector table widened to float32 at once when calculating similarities
+CHUNK_SIZE = 1024
+
+class NodeVectors:
+    '''Normalized vectors of the nodes of a tree, stored in float32, float16 or int8 precision.
+
+    The vector of a node is the unit vector of the mean of the word vectors of its tokens, so the dot product
+    of two node vectors is what n_similarity of the word vectors returns for their tokens. Only the distinct
+    vectors of the usable nodes (see VocabularyResolution) are stored in the vector table; ids maps every node
+    to its row in the table, or -1 if it is not usable. Nodes with the same tokens therefore share one vector
+    and always get exactly the same similarities.
+
+    In int8 precision every vector is quantized with its own scale, i.e. its largest absolute component
+    maps to 127. Similarities are always calculated in float32, the table is widened to float32 chunk by
+    chunk. The reduced precisions therefore only reduce the memory of the vector table; with numpy they are
+    not faster than float32, since the widening costs more than the smaller table saves.
+    '''
+    def __init__(self, resolution, wv, precision = FLOAT32):
+        assert precision in PRECISIONS, f'Unknown vector precision: {precision}'
+        self.resolution = resolution
+        self.precision = precision
+
+        nodes = len(resolution.identifiers)
+        usable = resolution.usable
+        tokens = usable[resolution.token_nodes]
+
+        sums = np.zeros((nodes, wv.vectors.shape[1]), dtype=np.float32)
+        np.add.at(sums, resolution.token_nodes[tokens], wv.vectors[resolution.indices[tokens]])
+        means = sums[usable] / resolution.node_token_counts[usable][:, None].astype(np.float32)
+        norms = np.linalg.norm(means, axis=1)
+        normalized = means / np.where(norms > 0, norms, 1)[:, None]
+
+        normalized, ids = np.unique(normalized, axis=0, return_inverse=True)
+        self.ids = np.full(nodes, -1, dtype=np.int32)
+        self.ids[usable] = ids.reshape(-1)
+
+        self.scales = None
+        if precision == FLOAT32:
+            self.matrix = normalized
+        elif precision == FLOAT16:
+            self.matrix = normalized.astype(np.float16)
+        else:
+            maxima = np.abs(normalized).max(axis=1)
+            self.scales = (np.where(maxima > 0, maxima, 1) / 127).astype(np.float32)
+            self.matrix = np.rint(normalized / self.scales[:, None]).astype(np.int8)
+
+    def rows(self, nodes):
+        return np.array([self.resolution.positions[node.identifier] for node in nodes], dtype=np.int32)
+
+    def __widen(self, ids):
+        block = self.matrix[ids].astype(np.float32, copy=False)
+        if self.scales is not None:
+            block = block * self.scales[ids][:, None]
+        return block
+
+    def similarities(self, ids):
+        '''Matrix of the similarities between the vectors ids and all vectors in the table.'''
+        block = self.__widen(ids)
+        if self.precision == FLOAT32:
+            return block @ self.matrix.T
+
+        result = np.empty((len(ids), len(self.matrix)), dtype=np.float32)
+        for start in range(0, len(self.matrix), CHUNK_SIZE):
+            chunk = slice(start, start + CHUNK_SIZE)
+            result[:, chunk] = block @ self.__widen(chunk).T
+        return result
@@ -0,0 +1,70 @@
+import numpy as np
+
+class VocabularyResolution:
+    '''Maps the tokens of every node in a tree to indices in the vocabulary of a word vector model.
+
+    The tree is tokenized in a single pass and each distinct token is looked up in the vocabulary only once.
+    The resulting indices are stored in one flat array, with the tokens of a node in the slice between its
+    offsets. Tokens that are not in the vocabulary get the index -1. The tree nodes themselves are not modified.
+    '''
+    def __init__(self, tree, wv):
+        #gensim is only needed for tokenizing, so that analysis units referencing a resolution can be loaded without it.
+        from gensim.utils import simple_preprocess
+
+        self.name = tree.get_node(tree.root).tag
+        #The node table: positions in these lists are the rows used by NodeVectors and the analysis units
+        self.identifiers = list()
+        self.nodes = list()
+        self.vocabulary = dict()
+        token_ids = list()
+        offsets = [0]
+
+        for node in tree.all_nodes_itr():
+            if node.identifier == tree.root:
+                continue
+            self.identifiers.append(node.identifier)
+            self.nodes.append(node)
+            for token in simple_preprocess(node.tag, max_len=100):
+                token_ids.append(self.vocabulary.setdefault(token, len(self.vocabulary)))
+            offsets.append(len(token_ids))
+
+        self.positions = {identifier: position for position, identifier in enumerate(self.identifiers)}
+        self.tokens = np.array(list(self.vocabulary), dtype=object)
+        self.token_ids = np.array(token_ids, dtype=np.int64)
+        self.offsets = np.array(offsets, dtype=np.int64)
+
+        lookup = np.array([wv.vocab[token].index if token in wv.vocab else -1 for token in self.tokens], dtype=np.int64)
+        self.indices = lookup[self.token_ids]
+        self.oov = self.indices < 0
+
+        #For every token position, the position of the node it belongs to
+        lengths = np.diff(self.offsets)
+        self.token_nodes = np.repeat(np.arange(len(self.identifiers)), lengths)
+        self.node_oov_counts = np.bincount(self.token_nodes, weights=self.oov, minlength=len(self.identifiers)).astype(np.int64)
+        self.node_token_counts = lengths
+        #A node is usable for similarity calculations if it has tokens and all of them are in the vocabulary.
+        self.usable = (self.node_token_counts > 0) & (self.node_oov_counts == 0)
+
+    def __slice(self, identifier):
+        position = self.positions[identifier]
+        return slice(self.offsets[position], self.offsets[position + 1])
+
+    def unknown_tokens(self, identifier):
+        s = self.__slice(identifier)
+        return list(self.tokens[self.token_ids[s][self.oov[s]]])
+
+    def describe(self):
+        '''Out-of-vocabulary report: which tokens are unknown and how many nodes each of them affects.'''
+        #Count every unknown token only once per node
+        node_token_pairs = np.unique(np.stack((self.token_nodes[self.oov], self.token_ids[self.oov])), axis=1)
+        affected = np.bincount(node_token_pairs[1], minlength=len(self.tokens))
+        oov_tokens = sorted(np.flatnonzero(affected), key=lambda token_id: (-affected[token_id], self.tokens[token_id]))
+
+        nodes = len(self.identifiers)
+        oov_nodes = np.count_nonzero(self.node_oov_counts)
+        empty_nodes = np.count_nonzero(self.node_token_counts == 0)
+
+        description = f'Classification system: {self.name} | Nodes: {nodes} | Nodes with unknown tokens: {oov_nodes} | Nodes without tokens: {empty_nodes} | Tokens/Unknown tokens: {len(self.tokens)}/{len(oov_tokens)}\n'
+        for token_id in oov_tokens:
+            description = description + f'\tToken: {self.tokens[token_id]} | Nodes: {affected[token_id]}\n'
+        return description